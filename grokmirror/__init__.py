@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import re
 import sys
 
 import time
@@ -35,7 +36,7 @@ import datetime
 from fcntl import lockf, LOCK_EX, LOCK_UN, LOCK_NB
 
 from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+from urllib3.util.retry import Retry
 
 from typing import Optional, Tuple, Union
 
@@ -168,7 +169,7 @@ def lock_repo(fullpath, nonblocking=False):
 
 def unlock_repo(fullpath):
     global REPO_LOCKH
-    if fullpath in REPO_LOCKH.keys():
+    if fullpath in REPO_LOCKH:
         logger.debug('Unlocking %s', fullpath)
         lockf(REPO_LOCKH[fullpath], LOCK_UN)
         REPO_LOCKH[fullpath].close()
@@ -191,6 +192,16 @@ def is_bare_git_repo(path):
     return False
 
 
+def get_gitdir(toplevel, fullpath):
+    # Cheaper than os.path.relpath, which we otherwise end up calling for
+    # every repo. Only use this with normalized paths (e.g. from os.walk or
+    # os.path.realpath), as we don't clean up things like trailing slashes.
+    prefix = toplevel.rstrip('/') + '/'
+    if fullpath.startswith(prefix):
+        return fullpath[len(prefix) - 1:]
+    return '/' + os.path.relpath(fullpath, toplevel)
+
+
 def get_repo_timestamp(toplevel, gitdir):
     ts = 0
 
@@ -476,9 +487,12 @@ def list_repo_remotes(fullpath, withurl=False):
         return out.split('\n')
 
     remotes = list()
+    # objstore repos can have thousands of remotes, so don't dedupe via the list
+    seen = set()
     for line in out.split('\n'):
         entry = tuple(line.split()[:2])
-        if entry not in remotes:
+        if entry not in seen:
+            seen.add(entry)
             remotes.append(entry)
     return remotes
 
@@ -642,6 +656,30 @@ def is_private_repo(config, fullpath):
     return False
 
 
+def get_glob_matcher(globs):
+    # Returns a function telling if a path matches any of the shell-style globs.
+    # Plain paths without wildcards are looked up in a set, and the rest are
+    # combined into a single regex, so this stays fast with many patterns.
+    literals = set()
+    patterns = list()
+    for glob in globs:
+        if '*' in glob or '?' in glob or '[' in glob:
+            patterns.append(glob)
+        else:
+            literals.add(glob)
+
+    regex = None
+    if patterns:
+        regex = re.compile('|'.join('(?:%s)' % fnmatch.translate(glob) for glob in patterns))
+
+    def matcher(path):
+        if path in literals:
+            return True
+        return regex is not None and regex.match(path) is not None
+
+    return matcher
+
+
 def find_siblings(fullpath, my_roots, known_roots, exact=False):
     siblings = set()
     for gitpath, gitroots in known_roots.items():
@@ -962,7 +1000,8 @@ def read_manifest(manifile, wait=False):
         fh = open(manifile, 'rb')
 
     logger.debug('Reading %s', manifile)
-    jdata = fh.read().decode('utf-8')
+    # json can parse utf-8 bytes directly, no need to decode them first
+    jdata = fh.read()
     fh.close()
 
     # noinspection PyBroadException
@@ -973,7 +1012,7 @@ def read_manifest(manifile, wait=False):
         logger.critical('Unable to parse %s, will regenerate', manifile)
         manifest = dict()
 
-    logger.debug('Manifest contains %s entries', len(manifest.keys()))
+    logger.debug('Manifest contains %s entries', len(manifest))
 
     return manifest
 
@@ -994,7 +1033,9 @@ def write_manifest(manifile, manifest, mtime=None, pretty=False):
 
         jdata = jdata.encode('utf-8')
         if manifile.endswith('.gz'):
-            gfh = gzip.GzipFile(fileobj=fh, mode='wb')
+            # Level 9 is several times slower than 6 and only shaves
+            # off about 1% on manifest json
+            gfh = gzip.GzipFile(fileobj=fh, mode='wb', compresslevel=6)
             gfh.write(jdata)
             gfh.close()
         else:
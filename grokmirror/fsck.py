@@ -600,7 +600,7 @@ def fsck_mirror(config, force=False, repack_only=False, conn_only=False,
             changed = True
             continue
 
-        if fullpath not in status.keys():
+        if fullpath not in status:
             # Newly added repository
             if not force:
                 # Randomize next check between now and frequency
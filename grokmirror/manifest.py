@@ -16,25 +16,115 @@
 
 import os
 import sys
+import json
+import time
 import logging
 import datetime
+import tempfile
+import shutil
 
 import grokmirror
 
+from concurrent.futures import ProcessPoolExecutor
+
 logger = logging.getLogger(__name__)
 
 objstore_uses_plumbing = False
 
 
-def update_manifest(manifest, toplevel, fullpath, usenow, ignorerefs):
-    logger.debug('Examining %s', fullpath)
-    if not grokmirror.is_bare_git_repo(fullpath):
-        logger.critical('Error opening %s.', fullpath)
-        logger.critical('Make sure it is a bare git repository.')
-        sys.exit(1)
+def get_repo_signature(fullpath, ignorerefs):
+    # Any change to refs, HEAD, description, owner or alternates will
+    # update the mtime of one of these files or ref directories
+    mtimes = list()
+    for entry in ('HEAD', 'config', 'description', 'packed-refs', 'objects/info/alternates',
+                  'reftable/tables.list'):
+        try:
+            mtimes.append(os.stat(os.path.join(fullpath, entry)).st_mtime_ns)
+        except FileNotFoundError:
+            mtimes.append(0)
+    for root, dirs, files in os.walk(os.path.join(fullpath, 'refs')):
+        mtimes.append(os.stat(root).st_mtime_ns)
+
+    # Don't trust anything modified very recently, as another change may
+    # land within the same mtime granularity without us noticing
+    if max(mtimes) / 1000000000 > time.time() - 2:
+        return None
+
+    return [sorted(ignorerefs or list())] + mtimes
+
+
+def read_cache(cachefile):
+    try:
+        with open(cachefile, 'r') as fh:
+            return json.load(fh)
+    except (IOError, json.JSONDecodeError):
+        logger.debug('Could not read %s', cachefile)
+        return dict()
+
+
+def write_cache(cachefile, cache):
+    (dirname, basename) = os.path.split(cachefile)
+    (fd, tmpfile) = tempfile.mkstemp(prefix=basename, dir=dirname)
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(cache, fh)
+        shutil.move(tmpfile, cachefile)
+    finally:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+    logger.debug('Wrote %s', cachefile)
+
+
+def get_repoinfo(toplevel, fullpath, usenow, ignorerefs):
+    gitdir = grokmirror.get_gitdir(toplevel, fullpath)
+    return grokmirror.get_repo_defs(toplevel, gitdir, usenow=usenow, ignorerefs=ignorerefs)
+
+
+def get_repoinfos(toplevel, fullpaths, usenow, ignorerefs, cache):
+    repoinfos = dict()
+    signatures = dict()
+    for fullpath in fullpaths:
+        if fullpath in repoinfos or fullpath in signatures:
+            continue
+        if usenow:
+            # Modified time is the time of this run, so don't look it up or store it
+            signatures[fullpath] = None
+            continue
+        gitdir = grokmirror.get_gitdir(toplevel, fullpath)
+        signature = get_repo_signature(fullpath, ignorerefs)
+        cached = cache.get(gitdir)
+        if signature is not None and cached and cached.get('signature') == signature:
+            logger.debug('No changes in %s, using cached repo info', gitdir)
+            repoinfos[fullpath] = dict(cached['repoinfo'])
+            continue
+        signatures[fullpath] = signature
+
+    tocompute = list(signatures)
+    if len(tocompute) > 1:
+        # Each repo needs several git commands, so run them in parallel
+        workers = min(os.cpu_count() or 1, len(tocompute))
+        chunksize = max(1, min(64, len(tocompute) // (workers * 4)))
+        count = len(tocompute)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(get_repoinfo, [toplevel] * count, tocompute, [usenow] * count,
+                                        [ignorerefs] * count, chunksize=chunksize))
+    else:
+        results = [get_repoinfo(toplevel, fullpath, usenow, ignorerefs) for fullpath in tocompute]
+
+    for fullpath, repoinfo in zip(tocompute, results):
+        repoinfos[fullpath] = repoinfo
+        if signatures[fullpath] is not None:
+            gitdir = grokmirror.get_gitdir(toplevel, fullpath)
+            cache[gitdir] = {
+                'signature': signatures[fullpath],
+                'repoinfo': dict(repoinfo),
+            }
+
+    return repoinfos
+
 
-    gitdir = '/' + os.path.relpath(fullpath, toplevel)
-    repoinfo = grokmirror.get_repo_defs(toplevel, gitdir, usenow=usenow, ignorerefs=ignorerefs)
+def update_manifest(manifest, toplevel, fullpath, repoinfo):
+    gitdir = grokmirror.get_gitdir(toplevel, fullpath)
     # Ignore it if it's an empty git repository
     if not repoinfo['fingerprint']:
         logger.info(' manifest: ignored %s (no heads)', gitdir)
@@ -61,13 +151,13 @@ def update_manifest(manifest, toplevel, fullpath, usenow, ignorerefs):
         if len(remotes):
             urls = list(x[1] for x in remotes)
             urls.sort()
-            reference = '/' + os.path.relpath(urls[0], toplevel)
+            reference = grokmirror.get_gitdir(toplevel, urls[0])
     else:
         reference = manifest[gitdir].get('reference', None)
 
     if altrepo and not reference and not repoinfo.get('forkgroup'):
         # Not an objstore repo
-        reference = '/' + os.path.relpath(altrepo, toplevel)
+        reference = grokmirror.get_gitdir(toplevel, altrepo)
 
     manifest[gitdir].update(repoinfo)
     # Always write a reference entry even if it's None, as grok-1.x clients expect it
@@ -75,6 +165,16 @@ def update_manifest(manifest, toplevel, fullpath, usenow, ignorerefs):
 
 
 def set_symlinks(manifest, toplevel, symlinks):
+    # Map references to the repos using them, so we don't have to walk
+    # the whole manifest for each symlink
+    referenced_by = dict()
+    for gitdir, repoinfo in manifest.items():
+        reference = repoinfo.get('reference')
+        if reference:
+            if reference not in referenced_by:
+                referenced_by[reference] = set()
+            referenced_by[reference].add(gitdir)
+
     for symlink in symlinks:
         target = os.path.realpath(symlink)
         if not os.path.exists(target):
@@ -84,7 +184,7 @@ def set_symlinks(manifest, toplevel, symlinks):
         if target.find(toplevel) < 0:
             logger.critical(' manifest: symlink %s points outside toplevel, ignored', relative)
             continue
-        tgtgitdir = '/' + os.path.relpath(target, toplevel)
+        tgtgitdir = grokmirror.get_gitdir(toplevel, target)
         if tgtgitdir not in manifest:
             logger.critical(' manifest: symlink %s points to %s, which we do not recognize', relative, tgtgitdir)
             continue
@@ -98,23 +198,28 @@ def set_symlinks(manifest, toplevel, symlinks):
             manifest[tgtgitdir]['symlinks'] = [relative]
             logger.info(' manifest: symlinked %s->%s', relative, tgtgitdir)
 
-        # Now go through all repos and fix any references pointing to the
-        # symlinked location. We shouldn't need to do anything with forkgroups.
-        for gitdir in manifest:
-            if manifest[gitdir] == relative:
-                logger.info(' manifest: removing %s (replaced by a symlink)', gitdir)
-                manifest.pop(gitdir)
+        if relative in manifest:
+            logger.info(' manifest: removing %s (replaced by a symlink)', relative)
+            manifest.pop(relative)
+
+        # Now fix any references pointing to the symlinked location.
+        # We shouldn't need to do anything with forkgroups.
+        for gitdir in referenced_by.pop(relative, set()):
+            if gitdir not in manifest:
                 continue
-            if manifest[gitdir]['reference'] == relative:
-                logger.info(' manifest: symlinked %s->%s', relative, tgtgitdir)
-                manifest[gitdir]['reference'] = tgtgitdir
+            logger.info(' manifest: symlinked %s->%s', relative, tgtgitdir)
+            manifest[gitdir]['reference'] = tgtgitdir
+            if tgtgitdir not in referenced_by:
+                referenced_by[tgtgitdir] = set()
+            referenced_by[tgtgitdir].add(gitdir)
 
 
 def purge_manifest(manifest, toplevel, gitdirs):
+    found = set(grokmirror.get_gitdir(toplevel, fullpath) for fullpath in gitdirs)
     for oldrepo in list(manifest):
-        if os.path.join(toplevel, oldrepo.lstrip('/')) not in gitdirs:
+        if '/' + oldrepo.lstrip('/') not in found:
             logger.info(' manifest: purged %s (gone)', oldrepo)
-            manifest.remove(oldrepo)
+            manifest.pop(oldrepo)
 
 
 def parse_args():
@@ -221,6 +326,8 @@ def grok_manifest(manifile, toplevel, paths=None, logfile=None, usenow=False,
 
     grokmirror.manifest_lock(manifile)
     manifest = grokmirror.read_manifest(manifile, wait=wait)
+    # Cache of repo info, so we don't rerun git commands for repos that haven't changed
+    cachefile = os.path.join(os.path.dirname(manifile), '.%s.cache' % os.path.basename(manifile))
 
     toplevel = os.path.realpath(toplevel)
 
@@ -255,9 +362,11 @@ def grok_manifest(manifile, toplevel, paths=None, logfile=None, usenow=False,
         return 0
 
     gitdirs = list()
+    fullscan = False
 
     if purge or not len(paths) or not len(manifest):
         # We automatically purge when we do a full tree walk
+        fullscan = True
         for gitdir in grokmirror.find_all_gitdirs(toplevel, ignore=ignore, exclude_objstore=True):
             gitdirs.append(gitdir)
         purge_manifest(manifest, toplevel, gitdirs)
@@ -266,6 +375,7 @@ def grok_manifest(manifile, toplevel, paths=None, logfile=None, usenow=False,
         # limit ourselves to passed dirs only when there is something
         # in the manifest. This precaution makes sure we regenerate the
         # whole file when there is nothing in it or it can't be parsed.
+        fullscan = False
         for apath in paths:
             arealpath = os.path.realpath(apath)
             if apath != arealpath and os.path.islink(apath):
@@ -273,14 +383,22 @@ def grok_manifest(manifile, toplevel, paths=None, logfile=None, usenow=False,
             else:
                 gitdirs.append(arealpath)
 
+    # The cache only pays off on full scans, and -n results depend on the
+    # time of the run, so never cache those
+    usecache = fullscan and not usenow
+    if usecache:
+        cache = read_cache(cachefile)
+    else:
+        cache = dict()
     symlinks = list()
     tofetch = set()
+    toupdate = list()
     for gitdir in gitdirs:
         # check to make sure this gitdir is ok to export
         if check_export_ok and not os.path.exists(os.path.join(gitdir, 'git-daemon-export-ok')):
             # is it curently in the manifest?
             repo = '/' + os.path.relpath(gitdir, toplevel)
-            if repo in list(manifest):
+            if repo in manifest:
                 logger.info(' manifest: removed %s (no longer exported)', repo)
                 manifest.pop(repo)
 
@@ -292,15 +410,32 @@ def grok_manifest(manifile, toplevel, paths=None, logfile=None, usenow=False,
         if os.path.islink(gitdir):
             symlinks.append(gitdir)
         else:
-            update_manifest(manifest, toplevel, gitdir, usenow, ignorerefs)
+            logger.debug('Examining %s', gitdir)
+            if not grokmirror.is_bare_git_repo(gitdir):
+                logger.critical('Error opening %s.', gitdir)
+                logger.critical('Make sure it is a bare git repository.')
+                sys.exit(1)
+            toupdate.append(gitdir)
             if fetchobst:
                 # Do it after we're done with manifest, to avoid keeping it locked
                 tofetch.add(gitdir)
 
+    repoinfos = get_repoinfos(toplevel, toupdate, usenow, ignorerefs, cache)
+    for gitdir in toupdate:
+        update_manifest(manifest, toplevel, gitdir, repoinfos[gitdir])
+
     if len(symlinks):
         set_symlinks(manifest, toplevel, symlinks)
 
     grokmirror.write_manifest(manifile, manifest, pretty=pretty)
+    if usecache:
+        # Don't keep cache entries for repos we didn't find on this scan (not checked
+        # against the manifest, since repos with no heads are left out of it)
+        scanned = set([grokmirror.get_gitdir(toplevel, x) for x in toupdate])
+        for gitdir in list(cache):
+            if gitdir not in scanned:
+                cache.pop(gitdir)
+        write_cache(cachefile, cache)
     grokmirror.manifest_unlock(manifile)
 
     fetched = set()
@@ -36,6 +36,7 @@ import uuid
 import multiprocessing as mp
 import queue
 
+from configparser import ConfigParser, Error
 from socketserver import UnixStreamServer, StreamRequestHandler, ThreadingMixIn
 
 # default basic logger. We override it later.
@@ -119,8 +120,13 @@ class ThreadedUnixStreamServer(ThreadingMixIn, UnixStreamServer):
 
 def build_optimal_forkgroups(l_manifest, r_manifest, toplevel, obstdir):
     r_forkgroups = dict()
-    for gitdir in set(r_manifest.keys()):
-        fullpath = os.path.join(toplevel, gitdir.lstrip('/'))
+    # Reverse map of fullpath -> forkgroup, so resolving references doesn't
+    # require scanning all forkgroups for every repo
+    r_fg_map = dict()
+    # Plain concatenation is a lot cheaper than os.path.join in this loop
+    prefix = toplevel.rstrip('/') + '/'
+    for gitdir in r_manifest:
+        fullpath = prefix + gitdir.lstrip('/')
         # our forkgroup info wins, because our own grok-fcsk may have found better siblings
         # unless we're cloning, in which case we have nothing to go by except remote info
         if gitdir in l_manifest:
@@ -136,20 +142,19 @@ def build_optimal_forkgroups(l_manifest, r_manifest, toplevel, obstdir):
 
         if reference and not forkgroup:
             # probably a grokmirror-1.x manifest
-            r_fullpath = os.path.join(toplevel, reference.lstrip('/'))
-            for fg, fps in r_forkgroups.items():
-                if r_fullpath in fps:
-                    forkgroup = fg
-                    break
+            r_fullpath = prefix + reference.lstrip('/')
+            forkgroup = r_fg_map.get(r_fullpath)
             if not forkgroup:
                 # I guess we get to make a new one!
                 forkgroup = str(uuid.uuid4())
                 r_forkgroups[forkgroup] = {r_fullpath}
+                r_fg_map[r_fullpath] = forkgroup
 
         if forkgroup is not None:
             if forkgroup not in r_forkgroups:
                 r_forkgroups[forkgroup] = set()
             r_forkgroups[forkgroup].add(fullpath)
+            r_fg_map.setdefault(fullpath, forkgroup)
 
     # Compare their forkgroups and my forkgroups in case we have a more optimal strategy
     forkgroups = grokmirror.get_forkgroups(obstdir, toplevel)
@@ -251,14 +256,18 @@ def objstore_repo_preload(config, obstrepo):
     burl = '%s/%s.bundle' % (purl.rstrip('/'), bname)
     bfile = os.path.join(obstdir, '%s.bundle' % bname)
     try:
+        # Pull workers reuse the same session for all preloads, so make sure
+        # the connection always goes back into the pool for keep-alive
         sess = grokmirror.get_requests_session()
-        resp = sess.get(burl, stream=True)
-        resp.raise_for_status()
-        logger.info(' objstore: downloading %s.bundle', bname)
-        with open(bfile, 'wb') as fh:
-            for chunk in resp.iter_content(chunk_size=8192):
-                fh.write(chunk)
-        resp.close()
+        with sess.get(burl, stream=True) as resp:
+            if resp.status_code >= 400:
+                # Read the (short) error body, otherwise the connection is dropped
+                resp.content  # noqa
+                resp.raise_for_status()
+            logger.info(' objstore: downloading %s.bundle', bname)
+            with open(bfile, 'wb') as fh:
+                for chunk in resp.iter_content(chunk_size=8192):
+                    fh.write(chunk)
     except: # noqa
         # Make sure we don't leave .bundle files lying around
         # Should we add logic to resume downloads here in the future?
@@ -270,7 +279,7 @@ def objstore_repo_preload(config, obstrepo):
     ecode, out, err = grokmirror.run_git_command(obstrepo, ['remote', 'add', '--mirror=fetch', '_preload', bfile])
     if ecode == 0:
         logger.info(' objstore: preloading %s.bundle', bname)
-        args = ['remote', 'update', '_preload']
+        args = ['fetch', '_preload']
         ecode, out, err = grokmirror.run_git_command(obstrepo, args)
         if ecode > 0:
             logger.info(' objstore: failed to preload from %s.bundle', bname)
@@ -465,25 +474,18 @@ def cull_manifest(manifest, config):
     includes = config['pull'].get('include', '*').split('\n')
     excludes = config['pull'].get('exclude', '').split('\n')
 
+    is_included = grokmirror.get_glob_matcher(includes)
+    is_excluded = grokmirror.get_glob_matcher(excludes)
+
     culled = dict()
 
     for gitdir, repoinfo in manifest.items():
         if not repoinfo.get('fingerprint'):
             logger.critical('Repo without fingerprint info (skipped): %s', gitdir)
             continue
-        # does it fall under include?
-        for include in includes:
-            if fnmatch.fnmatch(gitdir, include):
-                # Yes, but does it fall under excludes?
-                excluded = False
-                for exclude in excludes:
-                    if fnmatch.fnmatch(gitdir, exclude):
-                        excluded = True
-                        break
-                if excluded:
-                    continue
-
-                culled[gitdir] = manifest[gitdir]
+        # does it fall under include, but not under excludes?
+        if is_included(gitdir) and not is_excluded(gitdir):
+            culled[gitdir] = repoinfo
 
     return culled
 
@@ -519,6 +521,18 @@ def fix_remotes(toplevel, gitdir, site, config):
     return True
 
 
+def get_repo_owner(fullpath):
+    # Read the config file directly instead of forking git-config, since
+    # we only need this to find out if the owner needs to change. If we
+    # can't parse it, we just let git set it again.
+    gitconfig = ConfigParser(strict=False, interpolation=None)
+    try:
+        gitconfig.read(os.path.join(fullpath, 'config'), encoding='utf-8')
+        return gitconfig.get('gitweb', 'owner', fallback=None)
+    except (Error, UnicodeDecodeError):
+        return None
+
+
 def set_repo_params(fullpath, repoinfo):
     owner = repoinfo.get('owner')
     description = repoinfo.get('description')
@@ -538,7 +552,7 @@ def set_repo_params(fullpath, repoinfo):
             with open(descfile, 'w') as fh:
                 fh.write(description)
 
-    if owner is not None:
+    if owner is not None and get_repo_owner(fullpath) != owner:
         logger.debug('Setting %s owner to: %s', fullpath, owner)
         grokmirror.set_git_config(fullpath, 'gitweb.owner', owner)
 
@@ -561,9 +575,13 @@ def set_agefile(toplevel, gitdir, last_modified):
     # cgit recommends it to be yyyy-mm-dd hh:mm:ss
     cgit_fmt = time.strftime('%F %T', time.localtime(last_modified))
     agefile = os.path.join(toplevel, gitdir.lstrip('/'), 'info/web/last-modified')
-    if not os.path.exists(os.path.dirname(agefile)):
-        os.makedirs(os.path.dirname(agefile))
-    with open(agefile, 'wt') as fh:
+    # The directory is almost always there already, so don't stat it first
+    try:
+        fh = open(agefile, 'wt')
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(agefile), exist_ok=True)
+        fh = open(agefile, 'wt')
+    with fh:
         fh.write('%s\n' % cgit_fmt)
     logger.debug('Wrote "%s" into %s', cgit_fmt, agefile)
 
@@ -628,7 +646,9 @@ def run_post_update_hook(config, fullpath):
 
 
 def pull_repo(fullpath, remotename):
-    args = ['remote', 'update', remotename, '--prune']
+    # Call fetch directly, as "remote update" is just a wrapper that forks
+    # a "git fetch" for us
+    args = ['fetch', '--prune', remotename]
 
     retcode, output, error = grokmirror.run_git_command(fullpath, args)
 
@@ -755,6 +775,7 @@ def fill_todo_from_manifest(config, q_mani, nomtime=False, forcepurge=False):
             logger.debug('Could not read %s', r_mani_status_path)
             r_mani_status = dict()
         r_last_fetched = r_mani_status.get('last-fetched', 0)
+        r_etag = r_mani_status.get('etag')
         config_last_modified = r_mani_status.get('config-last-modified', 0)
         if config_last_modified != config.last_modified:
             nomtime = True
@@ -790,10 +811,15 @@ def fill_todo_from_manifest(config, q_mani, nomtime=False, forcepurge=False):
                 last_modified_h = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(r_last_fetched))
                 logger.debug('Our last-modified is: %s', last_modified_h)
                 headers['If-Modified-Since'] = last_modified_h
+                if r_etag:
+                    # Some servers and proxies are more reliable with etags
+                    logger.debug('Our etag is: %s', r_etag)
+                    headers['If-None-Match'] = r_etag
 
             try:
                 # 30 seconds to connect, 5 minutes between reads
-                res = session.get(r_mani_url, headers=headers, timeout=(30, 300))
+                # We stream the body so it can be decompressed as it arrives
+                res = session.get(r_mani_url, headers=headers, timeout=(30, 300), stream=True)
             except requests.exceptions.RequestException as ex:
                 logger.warning('Could not fetch %s', r_mani_url)
                 logger.warning('Server returned: %s', ex)
@@ -801,10 +827,12 @@ def fill_todo_from_manifest(config, q_mani, nomtime=False, forcepurge=False):
 
             if res.status_code == 304:
                 # No change to the manifest, nothing to do
+                res.close()
                 logger.info(' manifest: unchanged')
                 return
 
             if res.status_code > 200:
+                res.close()
                 logger.warning('Could not fetch %s', r_mani_url)
                 logger.warning('Server returned status: %s', res.status_code)
                 raise IOError('Remote server returned an error: %s' % res.status_code)
@@ -812,21 +840,20 @@ def fill_todo_from_manifest(config, q_mani, nomtime=False, forcepurge=False):
             r_last_modified = res.headers['Last-Modified']
             r_last_modified = time.strptime(r_last_modified, '%a, %d %b %Y %H:%M:%S %Z')
             r_last_modified = calendar.timegm(r_last_modified)
+            r_etag = res.headers.get('ETag')
 
             # We don't use read_manifest for the remote manifest, as it can be
             # anything, really. For now, blindly open it with gzipfile if it ends
             # with .gz. XXX: some http servers will auto-deflate such files.
             try:
+                # Undo any Content-Encoding the server applied, same as res.content would
+                res.raw.decode_content = True
                 if r_mani_url.rfind('.gz') > 0:
-                    import io
-                    fh = gzip.GzipFile(fileobj=io.BytesIO(res.content))
-                    jdata = fh.read().decode()
+                    fh = gzip.GzipFile(fileobj=res.raw)
+                    jdata = fh.read()
                 else:
-                    jdata = res.content
+                    jdata = res.raw.read()
 
-                res.close()
-                # Don't hold session open, since we don't refetch manifest very frequently
-                session.close()
                 r_manifest = json.loads(jdata)
 
             except Exception as ex:
@@ -834,11 +861,17 @@ def fill_todo_from_manifest(config, q_mani, nomtime=False, forcepurge=False):
                 logger.warning('Error was: %s', ex)
                 raise IOError('Failed to parse %s (%s)' % (r_mani_url, ex))
 
+            finally:
+                res.close()
+                # Don't hold session open, since we don't refetch manifest very frequently
+                session.close()
+
         # Record for the next run
         with open(r_mani_status_path, 'w') as fh:
             r_mani_status = {
                 'source': r_mani_url,
                 'last-fetched': r_last_modified,
+                'etag': r_etag,
                 'config-last-modified': config.last_modified,
             }
             json.dump(r_mani_status, fh)
@@ -856,7 +889,7 @@ def fill_todo_from_manifest(config, q_mani, nomtime=False, forcepurge=False):
     # populate private/forkgroup info in r_culled
     for forkgroup, siblings in forkgroups.items():
         for s_fullpath in siblings:
-            s_gitdir = '/' + os.path.relpath(s_fullpath, toplevel)
+            s_gitdir = grokmirror.get_gitdir(toplevel, s_fullpath)
 
             is_private = False
             for privmask in privmasks:
@@ -868,6 +901,16 @@ def fill_todo_from_manifest(config, q_mani, nomtime=False, forcepurge=False):
                 r_culled[s_gitdir]['forkgroup'] = forkgroup
                 r_culled[s_gitdir]['private'] = is_private
 
+    # Purging needs a full tree walk anyway, so reuse it to find the repos
+    # we already have and only stat the ones it didn't turn up
+    purge = config['pull'].getboolean('purge', False)
+    l_gitdirs = set()
+    if purge:
+        for founddir in grokmirror.find_all_gitdirs(toplevel, exclude_objstore=True):
+            l_gitdirs.add(grokmirror.get_gitdir(toplevel, founddir))
+
+    # Used instead of os.path.join for every manifest entry
+    prefix = toplevel.rstrip('/') + '/'
     seen = set()
     to_migrate = set()
     # Used to track symlinks so we can properly avoid purging them
@@ -881,11 +924,12 @@ def fill_todo_from_manifest(config, q_mani, nomtime=False, forcepurge=False):
         if gitdir in seen:
             continue
         seen.add(gitdir)
-        fullpath = os.path.join(toplevel, gitdir.lstrip('/'))
+        fullpath = prefix + gitdir.lstrip('/')
         forkgroup = repoinfo.get('forkgroup')
 
-        # Is the directory in place?
-        if os.path.exists(fullpath):
+        # Is the directory in place? The walk doesn't follow symlinked
+        # directories or descend into nested repos, so stat on a miss.
+        if gitdir in l_gitdirs or os.path.exists(fullpath):
             # Did grok-fsck request to reclone it?
             rfile = os.path.join(fullpath, 'grokmirror.reclone')
             if os.path.exists(rfile):
@@ -919,7 +963,7 @@ def fill_todo_from_manifest(config, q_mani, nomtime=False, forcepurge=False):
             if symlinks and isinstance(symlinks, list):
                 # Are all symlinks in place?
                 for symlink in symlinks:
-                    linkpath = os.path.join(toplevel, symlink.lstrip('/'))
+                    linkpath = prefix + symlink.lstrip('/')
                     if not os.path.islink(linkpath) or os.path.realpath(linkpath) != fullpath:
                         q_mani.put((gitdir, repoinfo, 'fix_params'))
                         break
@@ -954,7 +998,7 @@ def fill_todo_from_manifest(config, q_mani, nomtime=False, forcepurge=False):
         found_existing = False
         public_siblings = set()
         for s_fullpath in forkgroups[forkgroup]:
-            s_gitdir = '/' + os.path.relpath(s_fullpath, toplevel)
+            s_gitdir = grokmirror.get_gitdir(toplevel, s_fullpath)
             if s_gitdir == gitdir:
                 continue
 
@@ -969,7 +1013,7 @@ def fill_todo_from_manifest(config, q_mani, nomtime=False, forcepurge=False):
                 # Can't use this sibling for anything, as it's private
                 continue
 
-            if os.path.isdir(s_fullpath):
+            if s_gitdir in l_gitdirs or os.path.isdir(s_fullpath):
                 found_existing = True
                 if s_gitdir not in to_migrate:
                     # Plan to migrate it to objstore
@@ -998,30 +1042,26 @@ def fill_todo_from_manifest(config, q_mani, nomtime=False, forcepurge=False):
         # Finally, clone ourselves.
         q_mani.put((gitdir, repoinfo, 'init'))
 
-    if config['pull'].getboolean('purge', False):
-        nopurge = config['pull'].get('nopurge', '').split('\n')
+    if purge:
+        is_nopurge = grokmirror.get_glob_matcher(config['pull'].get('nopurge', '').split('\n'))
+        is_ffonly = grokmirror.get_glob_matcher(set([x.strip() for x in config['pull'].get('ffonly', '').split('\n')]))
+        # Everything we're supposed to have, including symlinks
+        expected = set(r_culled)
+        expected.update(all_symlinks)
         to_purge = set()
-        found_repos = 0
-        for founddir in grokmirror.find_all_gitdirs(toplevel, exclude_objstore=True):
-            gitdir = '/' + os.path.relpath(founddir, toplevel)
-            found_repos += 1
-
-            if gitdir not in r_culled and gitdir not in all_symlinks:
-                exclude = False
-                for entry in nopurge:
-                    if fnmatch.fnmatch(gitdir, entry):
-                        exclude = True
-                        break
-                # Refuse to purge ffonly repos
-                for globpatt in set([x.strip() for x in config['pull'].get('ffonly', '').split('\n')]):
-                    if fnmatch.fnmatch(gitdir, globpatt):
-                        # Woah, these are not supposed to be deleted, ever
-                        logger.critical('Refusing to purge ffonly repo %s', gitdir)
-                        exclude = True
-                        break
-                if not exclude:
-                    logger.debug('Adding %s to to_purge', gitdir)
-                    to_purge.add(gitdir)
+        found_repos = len(l_gitdirs)
+        for gitdir in l_gitdirs.difference(expected):
+            exclude = False
+            if is_nopurge(gitdir):
+                exclude = True
+            # Refuse to purge ffonly repos
+            if is_ffonly(gitdir):
+                # Woah, these are not supposed to be deleted, ever
+                logger.critical('Refusing to purge ffonly repo %s', gitdir)
+                exclude = True
+            if not exclude:
+                logger.debug('Adding %s to to_purge', gitdir)
+                to_purge.add(gitdir)
 
         if len(to_purge):
             # Purge-protection engage
@@ -1159,6 +1199,8 @@ def pull_mirror(config, nomtime=False, forcepurge=False, runonce=False):
     dws = list()
     mws = list()
     actions = set()
+    # gitdirs with a pending 'init' action, so we can quickly tell when all clones are done
+    inits = set()
     # Run in the main thread if we have runonce
     if runonce:
         fill_todo_from_manifest(config, q_mani, nomtime=nomtime, forcepurge=forcepurge)
@@ -1226,15 +1268,12 @@ def pull_mirror(config, nomtime=False, forcepurge=False, runonce=False):
                         actions.remove((gitdir, q_action))
                     except KeyError:
                         pass
+                    if q_action == 'init':
+                        inits.discard(gitdir)
                     # Was it a clone, and are all other clones done?
                     if post_clone_hook and q_action == 'init':
                         cloned.append(os.path.join(toplevel, gitdir.lstrip('/')))
-                        more_clones = False
-                        for qgd, qqa in actions:
-                            if qqa == 'init':
-                                more_clones = True
-                                break
-                        if not more_clones:
+                        if not len(inits):
                             # Fire the post_clone hook
                             run_post_clone_complete_hook(config, cloned)
                             cloned = list()
@@ -1269,6 +1308,8 @@ def pull_mirror(config, nomtime=False, forcepurge=False, runonce=False):
                         continue
 
                     actions.add((gitdir, action))
+                    if action == 'init':
+                        inits.add(gitdir)
                     q_todo.put((gitdir, repoinfo, action))
                     new_updates += 1
                     logger.debug('queued: %s, %s', gitdir, action)
@@ -1415,6 +1456,8 @@ def parse_args():
     op.add_argument('-o', '--continuous', dest='runonce',
                     action='store_false', default=True,
                     help='Run continuously (no effect if refresh is not set in config)')
+    op.add_argument('-j', '--jobs', dest='jobs', type=int, default=None,
+                    help='Number of concurrent pull workers (overrides pull.pull_threads)')
     op.add_argument('-c', '--config', dest='config',
                     required=True,
                     help='Location of the configuration file')
@@ -1423,7 +1466,7 @@ def parse_args():
     return op.parse_args()
 
 
-def grok_pull(cfgfile, verbose=False, nomtime=False, purge=False, forcepurge=False, runonce=False):
+def grok_pull(cfgfile, verbose=False, nomtime=False, purge=False, forcepurge=False, runonce=False, jobs=None):
     global logger
 
     config = grokmirror.load_config_file(cfgfile)
@@ -1440,6 +1483,10 @@ def grok_pull(cfgfile, verbose=False, nomtime=False, purge=False, forcepurge=Fal
         # Override the pull.purge setting
         config['pull']['purge'] = 'yes'
 
+    if jobs is not None:
+        # Override the pull.pull_threads setting
+        config['pull']['pull_threads'] = str(jobs)
+
     logger = grokmirror.init_logger('pull', logfile, loglevel, verbose)
 
     return pull_mirror(config, nomtime, forcepurge, runonce)
@@ -1449,7 +1496,7 @@ def command():
     opts = parse_args()
 
     retval = grok_pull(
-        opts.config, opts.verbose, opts.nomtime, opts.purge, opts.forcepurge, opts.runonce)
+        opts.config, opts.verbose, opts.nomtime, opts.purge, opts.forcepurge, opts.runonce, opts.jobs)
 
     sys.exit(retval)
 
@@ -55,6 +55,7 @@ setup(
     },
     install_requires=[
         'requests',
+        'urllib3',
     ],
     python_requires='>=3.6',
     entry_points={